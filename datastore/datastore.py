@@ -1,6 +1,7 @@
 import asyncio
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from models.models import (
     Document,
@@ -8,11 +9,18 @@ from models.models import (
     DocumentMetadataFilter,
     Query,
     QueryResult,
-    QueryWithEmbedding, CommandWithContent, Command,
+    QueryWithEmbedding, CommandWithContent, Command, CommandStatus,
 )
 from services.chunks import get_document_chunks
 from services.openai import get_embeddings
 
+# statuses after which a command will not change anymore
+FINAL_COMMAND_STATUSES = (CommandStatus.COMPLETED, CommandStatus.ERROR, CommandStatus.ABANDONED)
+# delays in seconds between two polls for a command status
+COMMAND_POLL_MIN_DELAY = 0.1
+COMMAND_POLL_MAX_DELAY = 2.0
+COMMAND_POLL_BACKOFF = 1.7
+
 
 class DataStore(ABC):
     async def upsert(
@@ -23,19 +31,10 @@ class DataStore(ABC):
         First deletes all the existing vectors with the document id (if necessary, depends on the vector db), then inserts the new ones.
         Return a list of document ids.
         """
-        # Delete any existing vectors for documents with the input document ids
-        await asyncio.gather(
-            *[
-                self.delete(
-                    filter=DocumentMetadataFilter(
-                        document_id=document.id,
-                    ),
-                    delete_all=False,
-                )
-                for document in documents
-                if document.id
-            ]
-        )
+        # Delete any existing vectors for documents with the input document ids, in a single call
+        document_ids = [document.id for document in documents if document.id]
+        if document_ids:
+            await self.delete(ids=document_ids, delete_all=False)
 
         chunks = get_document_chunks(documents, chunk_token_size)
 
@@ -58,7 +57,7 @@ class DataStore(ABC):
         query_embeddings = get_embeddings(query_texts)
         # hydrate the queries with embeddings
         queries_with_embeddings = [
-            QueryWithEmbedding(**query.dict(), embedding=embedding)
+            QueryWithEmbedding(**query.model_dump(), embedding=embedding)
             for query, embedding in zip(queries, query_embeddings)
         ]
         return await self._query(queries_with_embeddings)
@@ -99,8 +98,34 @@ class DataStore(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    async def update_command(self, command: Command) -> bool:
+    async def update_command(
+            self, command: Command, unless_status: Tuple[CommandStatus, ...] = ()
+    ) -> Command | None:
         """
-        Updates a command.
+        Updates a command, unless its current status is one of unless_status.
+        Returns the updated command, or None if it doesn't exist or wasn't updated.
         """
         raise NotImplementedError
+
+    async def close(self) -> None:
+        """
+        Releases the connections held by the datastore, called when the server shuts down.
+        """
+
+    async def wait_for_command(self, command_id: str, timeout: float) -> Command | None:
+        """
+        Waits for a command to reach a final status, giving up after timeout seconds.
+        Returns the last seen state of the command.
+        """
+        deadline = time.monotonic() + timeout
+        delay = COMMAND_POLL_MIN_DELAY
+        while True:
+            # Poll the database for the current status.
+            command = await self.get_command(command_id)
+            remaining = deadline - time.monotonic()
+            if command is None or command.status in FINAL_COMMAND_STATUSES or remaining <= 0:
+                return command
+
+            # Back off exponentially, so quick commands return fast and slow ones don't flood the database.
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * COMMAND_POLL_BACKOFF, COMMAND_POLL_MAX_DELAY)
@@ -2,16 +2,39 @@ from datastore.datastore import DataStore
 import os
 
 
+# providers are imported lazily, since they check their own environment variables on import
+async def _create_supabase_datastore() -> DataStore:
+    from datastore.providers.supabase_datastore import SupabaseDataStore
+    return SupabaseDataStore()
+
+
+async def _create_postgres_datastore() -> DataStore:
+    from datastore.providers.postgres_datastore import AsyncpgClient, PostgresDataStore
+    # open the connection pool now, so the first request doesn't pay for the handshakes
+    await AsyncpgClient.get_pool()
+    return PostgresDataStore()
+
+
+_PROVIDERS = {
+    "supabase": _create_supabase_datastore,
+    "postgres": _create_postgres_datastore,
+}
+
+# the datastore is created once and shared by every caller
+_datastore: DataStore | None = None
+
+
 async def get_datastore() -> DataStore:
-    datastore = os.environ.get("DATASTORE")
-    assert datastore is not None
-
-    match datastore:
-        case "supabase":
-            from datastore.providers.supabase_datastore import SupabaseDataStore
-            return SupabaseDataStore()
-        case _:
+    global _datastore
+    if _datastore is None:
+        datastore = os.environ.get("DATASTORE")
+        assert datastore is not None
+
+        create_datastore = _PROVIDERS.get(datastore)
+        if create_datastore is None:
             raise ValueError(
                 f"Unsupported vector database: {datastore}. "
-                f"Try one of the following: supabase"
-            )
\ No newline at end of file
+                f"Try one of the following: {', '.join(_PROVIDERS)}"
+            )
+        _datastore = await create_datastore()
+    return _datastore
@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+from itertools import islice
+from typing import Any, Dict, List, Optional, Tuple
 from uuid import uuid4
 
 from loguru import logger
@@ -14,24 +14,61 @@ from models.models import (
     QueryWithEmbedding,
     DocumentChunkWithScore,
     CommandWithContent,
-    Command
+    Command,
+    CommandStatus,
+    Source,
 )
 from services.date import to_unix_timestamp
 
+# maximum number of rows sent to the database in a single upsert call
+UPSERT_BATCH_SIZE = 500
+# parameters of the "match_page_sections" rpc function, see sql/match_page_sections_batch.sql for the batched variant
+MATCH_PAGE_SECTIONS_PARAMS = (
+    "in_embedding",
+    "in_match_count",
+    "in_document_id",
+    "in_source_id",
+    "in_source",
+    "in_author",
+    "in_start_date",
+    "in_end_date",
+)
+# "match_page_sections" parameters set from the query filter: (parameter, filter attribute, converter)
+_FILTER_PARAMS = (
+    ("in_document_id", "document_id", None),
+    ("in_source", "source", lambda source: source.value),
+    ("in_source_id", "source_id", None),
+    ("in_author", "author", None),
+    ("in_start_date", "start_date", to_unix_timestamp),
+    ("in_end_date", "end_date", to_unix_timestamp),
+)
+# columns of the commands table read by get_command, computed once instead of walking the schema on every poll
+_COMMAND_FIELDS = tuple(Command.model_fields.keys())
+# Sources the models don't know about are dropped instead of failing the whole query
+_SOURCES = {source.value: source for source in Source}
+
 
 # interface for Postgres client to implement pg based Datastore providers
 class PGClient(ABC):
     @abstractmethod
-    async def upsert(self, table: str, json: dict[str, Any]) -> None:
+    async def upsert(self, table: str, rows: List[dict[str, Any]]) -> None:
         """
-        Takes in a list of documents and inserts them into the table.
+        Takes in a list of rows and upserts them into the table in a single call.
         """
         raise NotImplementedError
 
     @abstractmethod
-    async def update(self, table: str, json: dict[str, Any]):
+    async def update(
+            self,
+            table: str,
+            json: dict[str, Any],
+            columns: Optional[Tuple[str, ...]] = None,
+            unless: Optional[Tuple[str, Tuple[str, ...]]] = None,
+    ) -> Any:
         """
         Takes in a table and an object and updates the table with the object.
+        unless is a (column, values) pair, rows whose column holds one of the values are left untouched.
+        Returns the updated rows, with the given columns where the client supports selecting them.
         """
         raise NotImplementedError
 
@@ -67,7 +104,7 @@ class PGClient(ABC):
 
     @abstractmethod
     async def get_by_id(
-            self, table: str, id: str, columns: Optional[List[str]] = None
+            self, table: str, id: str, columns: Optional[Tuple[str, ...]] = None
     ) -> Any:
         """
         Get a row by id from the database.
@@ -95,83 +132,103 @@ class PgVectorDataStore(DataStore):
         Takes in a dict of document_ids to list of document chunks and inserts them into the database.
         Return a list of document ids.
         """
-        for document_id, document_chunks in chunks.items():
-            for chunk in document_chunks:
-                json = {
-                    "id": chunk.id,
-                    "content": chunk.text,
-                    "embedding": chunk.embedding,
-                    "document_id": document_id,
-                    "source": chunk.metadata.source,
-                    "source_id": chunk.metadata.source_id,
-                    "url": chunk.metadata.url,
-                    "author": chunk.metadata.author,
-                }
-                if chunk.metadata.created_at:
-                    json["created_at"] = (
-                        datetime.fromtimestamp(
-                            to_unix_timestamp(chunk.metadata.created_at)
-                        ),
-                    )
-                await self.client.upsert("documents", json)
+        rows = iter(
+            [
+                self._chunk_row(document_id, chunk)
+                for document_id, document_chunks in chunks.items()
+                for chunk in document_chunks
+            ]
+        )
+        # send the rows in batches to avoid one round trip per chunk
+        while batch := list(islice(rows, UPSERT_BATCH_SIZE)):
+            await self.client.upsert("documents", batch)
 
         return list(chunks.keys())
 
+    def _chunk_row(self, document_id: str, chunk: DocumentChunk) -> Dict[str, Any]:
+        """
+        Builds the "documents" row of a chunk, with json ready values.
+        Empty metadata fields are kept as None, so re-upserting a chunk clears them and every row has the same keys.
+        """
+        row = {
+            "id": chunk.id,
+            "content": chunk.text,
+            "embedding": chunk.embedding,
+            "document_id": document_id,
+            **chunk.metadata.model_dump(
+                mode="json",
+                include={"source", "source_id", "url", "author"},
+            ),
+        }
+        if chunk.metadata.created_at:
+            # sent as a unix timestamp, the database converts it to a timestamptz
+            row["created_at"] = to_unix_timestamp(chunk.metadata.created_at)
+        return row
+
     async def _query(self, queries: List[QueryWithEmbedding]) -> List[QueryResult]:
         """
         Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
         """
-        query_results: List[QueryResult] = []
-        for query in queries:
-            # get the top 3 documents with the highest cosine similarity using rpc function in the database called "match_page_sections"
-            params = {
-                "in_embedding": query.embedding,
-            }
-            if query.top_k:
-                params["in_match_count"] = query.top_k
-            if query.filter:
-                if query.filter.document_id:
-                    params["in_document_id"] = query.filter.document_id
-                if query.filter.source:
-                    params["in_source"] = query.filter.source.value
-                if query.filter.source_id:
-                    params["in_source_id"] = query.filter.source_id
-                if query.filter.author:
-                    params["in_author"] = query.filter.author
-                if query.filter.start_date:
-                    params["in_start_date"] = datetime.fromtimestamp(
-                        to_unix_timestamp(query.filter.start_date)
-                    )
-                if query.filter.end_date:
-                    params["in_end_date"] = datetime.fromtimestamp(
-                        to_unix_timestamp(query.filter.end_date)
-                    )
-            logger.info(params)
-            try:
-                data = await self.client.rpc("match_page_sections", params=params)
-                results: List[DocumentChunkWithScore] = []
-                for row in data:
-                    document_chunk = DocumentChunkWithScore(
-                        id=row["id"],
-                        text=row["content"],
-                        # TODO: add embedding to the response ?
-                        # embedding=row["embedding"],
-                        score=float(row["similarity"]),
-                        metadata=DocumentChunkMetadata(
-                            source=row["source"],
-                            source_id=row["source_id"],
-                            document_id=row["document_id"],
-                            url=row["url"],
-                            created_at=row["created_at"],
-                            author=row["author"],
-                        ),
-                    )
-                    results.append(document_chunk)
-                query_results.append(QueryResult(query=query.query, results=results))
-            except Exception as e:
-                logger.error(e)
-                query_results.append(QueryResult(query=query.query, results=[]))
-        return query_results
+        # run all queries in a single call to the "match_page_sections_batch" rpc function, which takes
+        # one array per parameter with an element for each query and tags the returned rows with the query index.
+        # The embeddings are sent as one 2-D float array, which both clients can encode from nested lists.
+        query_params = [self._query_params(query) for query in queries]
+        params = {
+            name: [query_param.get(name) for query_param in query_params]
+            for name in MATCH_PAGE_SECTIONS_PARAMS
+        }
+        # params hold full embeddings, only format them when debug logging is enabled
+        logger.opt(lazy=True).debug("{}", lambda: params)
+        try:
+            data = await self.client.rpc("match_page_sections_batch", params=params)
+        except Exception as e:
+            # a failed batch leaves every query of the request without results
+            logger.error(f"Failed to run {len(queries)} queries through match_page_sections_batch: {e}")
+            return [QueryResult(query=query.query, results=[]) for query in queries]
+
+        # rows come from our own database, so the models are built without validation,
+        # the response is still validated once when it is returned from the API
+        results: List[List[DocumentChunkWithScore]] = [[] for _ in queries]
+        for row in data:
+            document_chunk = DocumentChunkWithScore.model_construct(
+                id=row["id"],
+                text=row["content"],
+                # TODO: add embedding to the response ?
+                # embedding=row["embedding"],
+                score=float(row["similarity"]),
+                metadata=DocumentChunkMetadata.model_construct(
+                    source=_SOURCES.get(row["source"]),
+                    source_id=row["source_id"],
+                    document_id=row["document_id"],
+                    url=row["url"],
+                    created_at=row["created_at"],
+                    author=row["author"],
+                ),
+            )
+            results[row["query_index"] - 1].append(document_chunk)
+        return [
+            QueryResult.model_construct(query=query.query, results=query_results)
+            for query, query_results in zip(queries, results)
+        ]
+
+    def _query_params(self, query: QueryWithEmbedding) -> Dict[str, Any]:
+        """
+        Builds the "match_page_sections" parameters for a single query, omitting the ones left at their defaults.
+        """
+        params = {
+            "in_embedding": query.embedding,
+        }
+        if query.top_k:
+            params["in_match_count"] = query.top_k
+        if query.filter:
+            params.update(
+                {
+                    name: convert(value) if convert else value
+                    for name, attribute, convert in _FILTER_PARAMS
+                    if (value := getattr(query.filter, attribute))
+                }
+            )
+        return params
 
     async def delete(
             self,
@@ -208,26 +265,49 @@ class PgVectorDataStore(DataStore):
         """
         command.id = str(uuid4())
         logger.info("got to create command in pgvector data store. Id: " + command.id)
-        logger.info("Command: " + str(command.dict()))
-        await self.client.upsert("commands", command.dict())
+        # empty fields are left out of the new row, so the database defaults apply
+        json = command.model_dump(mode="json", exclude_none=True)
+        logger.opt(lazy=True).debug("Command: {}", lambda: json)
+        await self.client.upsert("commands", [json])
         return command.id
 
     async def get_command(self, command_id: str) -> Command | None:
         """
         Queries the database for a command with the given id without the CommandContent.
         """
-        fields = list(Command.schema().get('properties').keys())
-        data = await self.client.get_by_id("commands", command_id, fields)
+        data = await self.client.get_by_id("commands", command_id, _COMMAND_FIELDS)
         if data:
-            return Command(**data[0])
+            return self._command_from_row(data[0])
         else:
             return None
 
-    async def update_command(self, command: Command) -> bool:
+    async def update_command(
+            self, command: Command, unless_status: Tuple[CommandStatus, ...] = ()
+    ) -> Command | None:
         """
-        Updates the command in the database.
-        Returns whether the operation was successful.
+        Updates the command in the database, unless its current status is one of unless_status.
+        Returns the updated command without the CommandContent, read back in the same round trip,
+        or None if no command was updated.
         """
-        logger.info("Attempting to update command in pgvector data store. Command: " + str(command))
-        await self.client.update("commands", command.dict())
-        return True
+        logger.opt(lazy=True).debug(
+            "Attempting to update command in pgvector data store. Command: {}", lambda: command
+        )
+        # None values are kept so fields like errors can be cleared, the timestamps are managed by the database
+        data = await self.client.update(
+            "commands",
+            command.model_dump(mode="json", exclude={"created_at", "updated_at"}),
+            columns=_COMMAND_FIELDS,
+            unless=("status", tuple(status.value for status in unless_status)) if unless_status else None,
+        )
+        if data:
+            return self._command_from_row(data[0])
+        else:
+            return None
+
+    def _command_from_row(self, row: Dict[str, Any]) -> Command:
+        """
+        Builds a command from a row of the commands table.
+        The row comes from our own database, so it's trusted and validation is skipped,
+        only the status is converted back to its enum.
+        """
+        return Command.model_construct(**{**row, "status": CommandStatus(row["status"])})
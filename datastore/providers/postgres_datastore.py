@@ -0,0 +1,365 @@
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import asyncpg
+from loguru import logger
+from pgvector.asyncpg import register_vector
+
+from datastore.datastore import FINAL_COMMAND_STATUSES
+from datastore.providers.pgvector_datastore import PGClient, PgVectorDataStore
+from models.models import (
+    DocumentMetadataFilter, Command, )
+from services.date import to_unix_timestamp
+
+PG_DSN = os.environ.get("PG_DSN")
+assert PG_DSN is not None, "PG_DSN is not set"
+PG_POOL_MIN_SIZE = int(os.environ.get("PG_POOL_MIN_SIZE", 10))
+PG_POOL_MAX_SIZE = int(os.environ.get("PG_POOL_MAX_SIZE", 50))
+# connection used to LISTEN for notifications, which needs a session: when PG_DSN goes through
+# pgbouncer in transaction mode, point this at the database directly or at a session mode pool
+PG_LISTEN_DSN = os.environ.get("PG_LISTEN_DSN", PG_DSN)
+# prepared statements kept per connection, set to 0 when connecting through pgbouncer in transaction mode
+PG_STATEMENT_CACHE_SIZE = int(os.environ.get("PG_STATEMENT_CACHE_SIZE", 100))
+# upsert batches with at least this many rows are sent with COPY instead of INSERT statements
+PG_COPY_MIN_ROWS = int(os.environ.get("PG_COPY_MIN_ROWS", 100))
+# schema the pgvector extension was created in
+PG_VECTOR_SCHEMA = os.environ.get("PG_VECTOR_SCHEMA", "public")
+# columns sent as unix timestamps, converted to timestamptz by the database
+EPOCH_COLUMNS = {"documents": ("created_at",)}
+# channel the commands table notifies on, see sql/commands_notify.sql
+COMMANDS_CHANNEL = "commands"
+
+
+# class that implements the DataStore interface for a Postgres database accessed directly through asyncpg
+class PostgresDataStore(PgVectorDataStore):
+    def create_db_client(self):
+        return AsyncpgClient()
+
+    async def close(self) -> None:
+        await AsyncpgClient.close_pool()
+
+    async def wait_for_command(self, command_id: str, timeout: float) -> Command | None:
+        """
+        Waits for a command to reach a final status, giving up after timeout seconds.
+        Instead of polling, wakes up on the notifications the commands table sends on status changes.
+        Returns the last seen state of the command.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # subscribe before the first read, so a status change in between is not missed
+        async with self.client.subscribe(COMMANDS_CHANNEL, command_id) as notifications:
+            command = await self.get_command(command_id)
+            while command is not None and command.status not in FINAL_COMMAND_STATUSES:
+                try:
+                    await asyncio.wait_for(notifications.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    # read it a last time, in case its notification was missed
+                    return await self.get_command(command_id)
+                command = await self.get_command(command_id)
+        return command
+
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    """
+    Registers the codecs every pooled connection needs, so embeddings and json columns
+    are passed as python objects instead of strings.
+    """
+    # embeddings are sent in pgvector's binary format (float32) instead of as text
+    await register_vector(conn, schema=PG_VECTOR_SCHEMA)
+    for json_type in ("json", "jsonb"):
+        await conn.set_type_codec(
+            json_type,
+            encoder=json.dumps,
+            decoder=json.loads,
+            schema="pg_catalog",
+        )
+
+
+# The statements below are cached per table and column set only to skip rebuilding the SQL strings,
+# reusing the prepared statements is left to asyncpg's own per-connection statement cache.
+@lru_cache(maxsize=None)
+def _upsert_sql(table: str, columns: Tuple[str, ...], source: Optional[str] = None) -> str:
+    column_list = ", ".join(columns)
+    epoch_columns = EPOCH_COLUMNS.get(table, ())
+    if source is None:
+        values = "VALUES (" + ", ".join(
+            f"to_timestamp(${i})" if column in epoch_columns else f"${i}"
+            for i, column in enumerate(columns, start=1)
+        ) + ")"
+    else:
+        values = "SELECT " + ", ".join(
+            f"to_timestamp({column})" if column in epoch_columns else column for column in columns
+        ) + f" FROM {source}"
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column != "id")
+    return f"INSERT INTO {table} ({column_list}) {values} ON CONFLICT (id) DO UPDATE SET {updates}"
+
+
+@lru_cache(maxsize=None)
+def _staging_table_sql(table: str, columns: Tuple[str, ...], staging_table: str) -> str:
+    # only the copied columns are taken over, without constraints, and epoch columns become bigint
+    epoch_columns = EPOCH_COLUMNS.get(table, ())
+    selected = ", ".join(
+        f"NULL::bigint AS {column}" if column in epoch_columns else column for column in columns
+    )
+    return f"CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS SELECT {selected} FROM {table} WITH NO DATA"
+
+
+@lru_cache(maxsize=None)
+def _update_sql(
+        table: str,
+        columns: Tuple[str, ...],
+        returning: Tuple[str, ...],
+        unless_column: Optional[str] = None,
+) -> str:
+    assignments = ", ".join(f"{column} = ${i}" for i, column in enumerate(columns, start=2))
+    condition = "id = $1"
+    if unless_column is not None:
+        condition += f" AND {unless_column}::text <> ALL(${len(columns) + 2}::text[])"
+    return f"UPDATE {table} SET {assignments} WHERE {condition} RETURNING {', '.join(returning)}"
+
+
+@lru_cache(maxsize=None)
+def _select_by_id_sql(table: str, columns: Tuple[str, ...]) -> str:
+    return f"SELECT {', '.join(columns)} FROM {table} WHERE id = $1"
+
+
+@lru_cache(maxsize=None)
+def _rpc_sql(function_name: str, params: Tuple[str, ...]) -> str:
+    arguments = ", ".join(f"{name} => ${i}" for i, name in enumerate(params, start=1))
+    return f"SELECT * FROM {function_name}({arguments})"
+
+
+class AsyncpgClient(PGClient):
+
+    # one pool is shared by every client in the process, created on first use
+    _pool: Optional[asyncpg.Pool] = None
+    _pool_lock = asyncio.Lock()
+
+    @classmethod
+    async def get_pool(cls) -> asyncpg.Pool:
+        if cls._pool is None:
+            async with cls._pool_lock:
+                if cls._pool is None:
+                    cls._pool = await asyncpg.create_pool(
+                        PG_DSN,
+                        min_size=PG_POOL_MIN_SIZE,
+                        max_size=PG_POOL_MAX_SIZE,
+                        statement_cache_size=PG_STATEMENT_CACHE_SIZE,
+                        init=_init_connection,
+                    )
+        return cls._pool
+
+    @classmethod
+    async def close_pool(cls) -> None:
+        """
+        Closes the shared pool and the notification listener, so no server connections are left behind.
+        """
+        async with cls._pool_lock:
+            if cls._pool is not None:
+                await cls._pool.close()
+                cls._pool = None
+        async with cls._listener_lock:
+            if cls._listener is not None:
+                listener, cls._listener = cls._listener, None
+                await listener.close()
+            cls._subscriptions.clear()
+
+    # one connection per process, outside the pool, receives the notifications of every channel and
+    # hands each payload ("<key>:<message>") to the queues subscribed to its key
+    _listener: Optional[asyncpg.Connection] = None
+    _listener_lock = asyncio.Lock()
+    _subscriptions: Dict[str, Dict[str, Set[asyncio.Queue]]] = {}
+    _reconnect_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def _dispatch(cls, connection, pid, channel: str, payload: str) -> None:
+        key, _, message = payload.rpartition(":")
+        for queue in cls._subscriptions.get(channel, {}).get(key, ()):
+            queue.put_nowait(message)
+
+    @classmethod
+    async def _connect_listener(cls) -> asyncpg.Connection:
+        """
+        Opens the listener connection if there is none, listening again on every subscribed channel.
+        Must be called with the listener lock held.
+        """
+        if cls._listener is None or cls._listener.is_closed():
+            cls._listener = await asyncpg.connect(PG_LISTEN_DSN)
+            cls._listener.add_termination_listener(cls._on_listener_terminated)
+            for channel in cls._subscriptions:
+                await cls._listener.add_listener(channel, cls._dispatch)
+        return cls._listener
+
+    @classmethod
+    def _on_listener_terminated(cls, connection: asyncpg.Connection) -> None:
+        # a lost connection is reopened right away, so the requests already waiting keep getting notifications,
+        # a connection closed by close_pool has been unset before
+        if connection is cls._listener:
+            cls._reconnect_task = asyncio.get_running_loop().create_task(cls._reconnect_listener())
+
+    @classmethod
+    async def _reconnect_listener(cls) -> None:
+        try:
+            async with cls._listener_lock:
+                await cls._connect_listener()
+        except Exception as e:
+            logger.error(f"Failed to reopen the notification listener connection: {e}")
+
+    @classmethod
+    async def _listen(cls, channel: str) -> Dict[str, Set[asyncio.Queue]]:
+        async with cls._listener_lock:
+            listener = await cls._connect_listener()
+            if channel not in cls._subscriptions:
+                await listener.add_listener(channel, cls._dispatch)
+                cls._subscriptions[channel] = {}
+        return cls._subscriptions[channel]
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str, key: str) -> AsyncIterator[asyncio.Queue]:
+        """
+        Yields a queue receiving the messages of the notifications sent on the channel for the key,
+        while the context is open. Notification payloads have the form "<key>:<message>".
+        """
+        subscribers = await self._listen(channel)
+        queue: asyncio.Queue = asyncio.Queue()
+        subscribers.setdefault(key, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers[key].discard(queue)
+            if not subscribers[key]:
+                del subscribers[key]
+
+    def _record_to_dict(self, record: asyncpg.Record) -> dict[str, Any]:
+        """
+        Converts a record to a dict, with timestamps as iso strings like the rest of the app expects.
+        """
+        return {
+            k: v.isoformat() if isinstance(v, datetime) else v
+            for k, v in record.items()
+        }
+
+    async def upsert(self, table: str, rows: List[dict[str, Any]]):
+        """
+        Takes in a list of rows and upserts them into the table.
+        """
+        # rows are grouped by their set of columns, since each INSERT statement has a fixed column list
+        groups: Dict[Tuple[str, ...], List[Tuple[Any, ...]]] = {}
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(tuple(row.values()))
+
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                for columns, records in groups.items():
+                    if len(records) < PG_COPY_MIN_ROWS:
+                        await conn.executemany(_upsert_sql(table, columns), records)
+                        continue
+
+                    # large batches are streamed with COPY into a temporary table, then merged in one statement
+                    staging_table = f"{table}_staging"
+                    await conn.execute(_staging_table_sql(table, columns, staging_table))
+                    await conn.copy_records_to_table(
+                        staging_table, records=records, columns=columns
+                    )
+                    await conn.execute(_upsert_sql(table, columns, staging_table))
+                    await conn.execute(f"DROP TABLE {staging_table}")
+
+    async def update(
+            self,
+            table: str,
+            json: dict[str, Any],
+            columns: Optional[Tuple[str, ...]] = None,
+            unless: Optional[Tuple[str, Tuple[str, ...]]] = None,
+    ):
+        """
+        Takes in a table and an object and updates the row with the object's id,
+        unless the row's unless[0] column holds one of the unless[1] values.
+        Returns the updated rows with the given columns.
+        """
+        updated_columns = tuple(column for column in json if column != "id")
+        args = [json["id"], *(json[column] for column in updated_columns)]
+        if unless is not None:
+            args.append(list(unless[1]))
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            records = await conn.fetch(
+                _update_sql(
+                    table,
+                    updated_columns,
+                    columns or ("*",),
+                    unless[0] if unless is not None else None,
+                ),
+                *args,
+            )
+        return [self._record_to_dict(record) for record in records]
+
+    async def get_by_id(self, table: str, id: str, columns: Optional[Tuple[str, ...]] = None) -> Any:
+        """
+        Get a row by id from the database.
+        """
+        if columns is None:
+            columns = ("*",)
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            records = await conn.fetch(_select_by_id_sql(table, columns), id)
+        return [self._record_to_dict(record) for record in records]
+
+    async def rpc(self, function_name: str, params: dict[str, Any]):
+        """
+        Calls a stored procedure in the database with the given parameters.
+        """
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            records = await conn.fetch(
+                _rpc_sql(function_name, tuple(params)), *params.values()
+            )
+        return [self._record_to_dict(record) for record in records]
+
+    async def delete_like(self, table: str, column: str, pattern: str):
+        """
+        Deletes rows in the table that match the pattern.
+        """
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(f"DELETE FROM {table} WHERE {column} LIKE $1", pattern)
+
+    async def delete_in(self, table: str, column: str, ids: List[str]):
+        """
+        Deletes rows in the table that match the ids.
+        """
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(f"DELETE FROM {table} WHERE {column} = ANY($1::text[])", ids)
+
+    async def delete_by_filters(self, table: str, filter: DocumentMetadataFilter):
+        """
+        Deletes rows in the table that match the filter.
+        """
+        conditions = {}
+        if filter.document_id:
+            conditions["document_id = {}"] = filter.document_id
+        if filter.source:
+            conditions["source = {}"] = filter.source.value
+        if filter.source_id:
+            conditions["source_id = {}"] = filter.source_id
+        if filter.author:
+            conditions["author = {}"] = filter.author
+        if filter.start_date:
+            conditions["created_at >= to_timestamp({})"] = to_unix_timestamp(filter.start_date)
+        if filter.end_date:
+            conditions["created_at <= to_timestamp({})"] = to_unix_timestamp(filter.end_date)
+        if not conditions:
+            logger.warning(f"Refusing to delete from {table} without any filter")
+            return
+        where = " AND ".join(
+            condition.format(f"${i}") for i, condition in enumerate(conditions, start=1)
+        )
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(f"DELETE FROM {table} WHERE {where}", *conditions.values())
@@ -0,0 +1,18 @@
+-- Notifies listeners on the 'commands' channel whenever a command changes status.
+-- The payload is '<id>:<status>'.
+create or replace function notify_command_status()
+returns trigger
+language plpgsql
+as $$
+begin
+  perform pg_notify('commands', new.id || ':' || new.status::text);
+  return new;
+end;
+$$;
+
+drop trigger if exists commands_status_notify on commands;
+create trigger commands_status_notify
+after update of status on commands
+for each row
+when (old.status is distinct from new.status)
+execute function notify_command_status();
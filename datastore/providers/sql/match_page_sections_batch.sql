@@ -0,0 +1,47 @@
+-- Runs match_page_sections for several queries in a single call.
+-- in_embedding is a 2-D array with one row per query, so clients can send it as a plain nested list;
+-- every other parameter is an array with one element per query, null elements fall back to
+-- the defaults of match_page_sections. Dates are unix timestamps.
+-- Rows are tagged with the 1-based query_index.
+create or replace function match_page_sections_batch(in_embedding real[]
+                                                  , in_match_count int[] default null
+                                                  , in_document_id text[] default null
+                                                  , in_source_id text[] default null
+                                                  , in_source text[] default null
+                                                  , in_author text[] default null
+                                                  , in_start_date bigint[] default null
+                                                  , in_end_date bigint[] default null)
+returns table (query_index int
+            , id text
+            , source text
+            , source_id text
+            , document_id text
+            , url text
+            , created_at timestamptz
+            , author text
+            , content text
+            , similarity float)
+language sql
+stable
+as $$
+select q.query_index
+     , r.id
+     , r.source
+     , r.source_id
+     , r.document_id
+     , r.url
+     , r.created_at
+     , r.author
+     , r.content
+     , r.similarity
+from generate_subscripts(in_embedding, 1) as q(query_index)
+cross join lateral match_page_sections(
+         in_embedding => array(select unnest(in_embedding[q.query_index:q.query_index][:]))::vector(1536)
+       , in_match_count => coalesce(in_match_count[q.query_index], 3)
+       , in_document_id => coalesce(in_document_id[q.query_index], '%%')
+       , in_source_id => coalesce(in_source_id[q.query_index], '%%')
+       , in_source => coalesce(in_source[q.query_index], '%%')
+       , in_author => coalesce(in_author[q.query_index], '%%')
+       , in_start_date => coalesce(to_timestamp(in_start_date[q.query_index]), '-infinity')
+       , in_end_date => coalesce(to_timestamp(in_end_date[q.query_index]), 'infinity')) r;
+$$;
@@ -1,6 +1,7 @@
 import os
-from enum import Enum
-from typing import Any, List, Optional
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 
 from loguru import logger
 from supabase import Client
@@ -8,6 +9,7 @@ from supabase import Client
 from datastore.providers.pgvector_datastore import PGClient, PgVectorDataStore
 from models.models import (
     DocumentMetadataFilter, )
+from services.date import to_unix_timestamp
 
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 assert SUPABASE_URL is not None, "SUPABASE_URL is not set"
@@ -17,6 +19,18 @@ SUPABASE_SERVICE_ROLE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 assert (
         SUPABASE_ANON_KEY is not None or SUPABASE_SERVICE_ROLE_KEY is not None
 ), "SUPABASE_ANON_KEY or SUPABASE_SERVICE_ROLE_KEY must be set"
+# maximum number of ids in a single PostgREST "in" filter
+DELETE_IN_BATCH_SIZE = 100
+
+
+@lru_cache(maxsize=None)
+def _select_columns(columns: Tuple[str, ...]) -> str:
+    return ",".join(columns)
+
+
+def _to_utc_isoformat(timestamp: int) -> str:
+    # PostgREST can't convert unix timestamps, unlike the SQL based clients
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
 
 
 # class that implements the DataStore interface for Supabase Datastore provider
@@ -34,64 +48,62 @@ class SupabaseClient(PGClient):
         else:
             self.client = Client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
-    async def upsert(self, table: str, json: dict[str, Any]):
-        """
-        Takes in a list of documents and inserts them into the table.
-        """
-
-        logger.info("Got to upsert in supabase_datastore.py")
-        logger.info("Json before conversion: " + str(json))
-        json = self._convert_object_to_serializable_json(json)
-        logger.info("Json after conversion: " + str(json))
-
-        if "created_at" in json:
-            json["created_at"] = json["created_at"][0].isoformat()
-
-        try:
-            self.client.table(table).upsert(json).execute()
-        except Exception as e:
-            logger.error("Got exception in supabase_datastore.py: " + str(e), e)
-
-    def _convert_object_to_serializable_json(self, data: Any) -> Any:
-        """
-        Converts an object to a serializable json object.
-        """
-        if isinstance(data, dict):
-            return {k: self._convert_object_to_serializable_json(v) for k, v in data.items() if v is not None}
-        elif isinstance(data, list):
-            return [self._convert_object_to_serializable_json(v) for v in data]
-        elif isinstance(data, Enum):
-            return data.value
-        else:
-            return data
-
-    async def update(self, table: str, json: dict[str, Any]):
-        """
-        Takes in a list of documents and inserts them into the table.
-        """
-        logger.info("Command before serializing: " + str(json))
-        json = self._convert_object_to_serializable_json(json)
-        logger.info("Command after serializing: " + str(json))
-        self.client.table(table).update(json).eq("id", json["id"]).execute()
+    async def upsert(self, table: str, rows: List[dict[str, Any]]):
+        """
+        Takes in a list of rows and upserts them into the table, with one request per set of row keys.
+        """
+
+        logger.debug("Got to upsert in supabase_datastore.py")
+        # rows hold full embeddings, only format them when debug logging is enabled
+        logger.opt(lazy=True).debug("Rows: {}", lambda: rows)
+
+        # PostgREST rejects bulk payloads whose objects don't all have the same keys,
+        # so rows are grouped by their set of keys
+        groups: Dict[Tuple[str, ...], List[dict[str, Any]]] = {}
+        for json in rows:
+            if "created_at" in json:
+                json["created_at"] = _to_utc_isoformat(json["created_at"])
+            groups.setdefault(tuple(sorted(json)), []).append(json)
+
+        for group in groups.values():
+            try:
+                self.client.table(table).upsert(group).execute()
+            except Exception as e:
+                logger.error(f"Failed to upsert {len(group)} rows into {table}: {e}")
+                raise
+
+    async def update(
+            self,
+            table: str,
+            json: dict[str, Any],
+            columns: Optional[Tuple[str, ...]] = None,
+            unless: Optional[Tuple[str, Tuple[str, ...]]] = None,
+    ):
+        """
+        Takes in a table and an object and updates the row with the object's id,
+        unless the row's unless[0] column holds one of the unless[1] values.
+        Returns the updated rows, PostgREST always sends back every column of them.
+        """
+        logger.opt(lazy=True).debug("Command: {}", lambda: json)
+        builder = self.client.table(table).update(json, returning="representation").eq("id", json["id"])
+        if unless is not None:
+            builder = builder.not_.in_(unless[0], list(unless[1]))
+        response = builder.execute()
+        return response.data
 
-    async def get_by_id(self, table: str, id: str, columns: Optional[List[str]] = None) -> Any:
+    async def get_by_id(self, table: str, id: str, columns: Optional[Tuple[str, ...]] = None) -> Any:
         """
         Get a row by id from the database.
         """
         if columns is None:
-            columns = ["*"]
-        response = self.client.table(table).select(",".join(columns)).eq("id", id).execute()
+            columns = ("*",)
+        response = self.client.table(table).select(_select_columns(columns)).eq("id", id).execute()
         return response.data
 
     async def rpc(self, function_name: str, params: dict[str, Any]):
         """
         Calls a stored procedure in the database with the given parameters.
         """
-        if "in_start_date" in params:
-            params["in_start_date"] = params["in_start_date"].isoformat()
-        if "in_end_date" in params:
-            params["in_end_date"] = params["in_end_date"].isoformat()
-
         response = self.client.rpc(function_name, params=params).execute()
         return response.data
 
@@ -104,8 +116,10 @@ class SupabaseClient(PGClient):
     async def delete_in(self, table: str, column: str, ids: List[str]):
         """
         Deletes rows in the table that match the ids.
+        The ids end up in the request URL, so they are sent in batches to stay within URL length limits.
         """
-        self.client.table(table).delete().in_(column, ids).execute()
+        for i in range(0, len(ids), DELETE_IN_BATCH_SIZE):
+            self.client.table(table).delete().in_(column, ids[i:i + DELETE_IN_BATCH_SIZE]).execute()
 
     async def delete_by_filters(self, table: str, filter: DocumentMetadataFilter):
         """
@@ -126,11 +140,11 @@ class SupabaseClient(PGClient):
         if filter.start_date:
             builder = builder.gte(
                 "created_at",
-                filter.start_date[0].isoformat(),
+                _to_utc_isoformat(to_unix_timestamp(filter.start_date)),
             )
         if filter.end_date:
             builder = builder.lte(
                 "created_at",
-                filter.end_date[0].isoformat(),
+                _to_utc_isoformat(to_unix_timestamp(filter.end_date)),
             )
         builder.execute()
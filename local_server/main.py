@@ -1,13 +1,11 @@
 # This is a version of the main.py file found in ../../../server/main.py for testing the plugin locally.
 # Use the command `poetry run dev` to run this.
-import asyncio
-import time
-
 import uvicorn
 from fastapi import FastAPI, HTTPException, Body
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
-from starlette.responses import FileResponse
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
 
 from datastore.factory import get_datastore
 from models.api import (
@@ -23,6 +21,8 @@ from models.models import CommandStatus
 app = FastAPI()
 
 PORT = 3333
+# seconds to wait for Obsidian to execute a command before abandoning it
+COMMAND_TIMEOUT = 20
 
 origins = [
     f"http://localhost:{PORT}",
@@ -38,23 +38,18 @@ app.add_middleware(
 )
 
 
-@app.route("/.well-known/ai-plugin.json")
-async def get_manifest(request):
-    file_path = "./local_server/ai-plugin.json"
-    simple_headers = {"Access-Control-Allow-Private-Network": "true"}
-    return FileResponse(file_path, media_type="text/json", headers=simple_headers)
-
+class WellKnownFiles(StaticFiles):
+    """
+    Serves the plugin manifest, logo and OpenAPI spec, allowing ChatGPT to reach them on the private network.
+    """
 
-@app.route("/.well-known/logo.png")
-async def get_logo(request):
-    file_path = "./local_server/logo.png"
-    return FileResponse(file_path, media_type="text/json")
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["Access-Control-Allow-Private-Network"] = "true"
+        return response
 
 
-@app.route("/.well-known/openapi.yaml")
-async def get_openapi(request):
-    file_path = "./local_server/openapi.yaml"
-    return FileResponse(file_path, media_type="text/json")
+app.mount("/.well-known", WellKnownFiles(directory="./local_server/.well-known"), name="well-known")
 
 
 @app.post(
@@ -82,25 +77,22 @@ async def create_command(
     logger.info("Received Command: " + str(request.command))
     try:
         id = await datastore.create_command(request.command)
-        start_time = time.time()
-        while True:
-            logger.info("Polling for command status...")
-            # Poll the database for the current status.
-            command = await datastore.get_command(id)
-            if command.status == CommandStatus.COMPLETED:
-                return CommandResponse(id=id, errors=None)
-            elif command.status == CommandStatus.ERROR:
-                return CommandResponse(id=id, errors=command.errors)
-
-            # Check if we've been polling for over a minute.
-            if time.time() - start_time > 20:
-                # Update the command status to 'ABANDONED'
-                request.command.status = CommandStatus.ABANDONED
-                await datastore.update_command(request.command)
-                return CommandResponse(id=id, errors="Command was abandoned due to timeout. Check Obsidian connection")
-
-            # Wait a few seconds before polling again.
-            await asyncio.sleep(5)
+        command = await datastore.wait_for_command(id, timeout=COMMAND_TIMEOUT)
+        if command is not None and command.status not in (CommandStatus.COMPLETED, CommandStatus.ERROR):
+            # The command did not finish in time, update the command status to 'ABANDONED',
+            # unless Obsidian finished it in the meantime, in which case its current state is reported
+            request.command.status = CommandStatus.ABANDONED
+            command = await datastore.update_command(
+                request.command, unless_status=(CommandStatus.COMPLETED, CommandStatus.ERROR)
+            ) or await datastore.get_command(id)
+
+        if command is None:
+            return CommandResponse(id=id, errors="Command was not found, it may have been deleted")
+        elif command.status == CommandStatus.COMPLETED:
+            return CommandResponse(id=id, errors=None)
+        elif command.status == CommandStatus.ERROR:
+            return CommandResponse(id=id, errors=command.errors)
+        return CommandResponse(id=id, errors="Command was abandoned due to timeout. Check Obsidian connection")
     except Exception as e:
         logger.error(e)
         logger.error(e.__cause__)
@@ -149,5 +141,10 @@ async def startup():
     datastore = await get_datastore()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await datastore.close()
+
+
 def start():
     uvicorn.run("local_server.main:app", host="localhost", port=PORT, reload=True)
@@ -22,7 +22,7 @@ class CommandRequest(BaseModel):
 
 class CommandResponse(BaseModel):
     id: str
-    errors: Optional[str]
+    errors: Optional[str] = None
 
 
 class QueryRequest(BaseModel):
@@ -87,11 +87,11 @@ class CommandContent(BaseModel):
 
 
 class Command(BaseModel):
-    id: Optional[str]
+    id: Optional[str] = None
     status: CommandStatus = CommandStatus.NEW
-    errors: Optional[str]
-    created_at: Optional[str]
-    updated_at: Optional[str]
+    errors: Optional[str] = None
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
 
 
 class CommandWithContent(Command):